@@ -4,11 +4,19 @@ A crawler/download script to download mangas and other comics from some websites
 
 import argparse
 import asyncio
+import contextlib
+import cProfile
 from importlib.metadata import version, PackageNotFoundError
 import logging
 from pathlib import Path
+import pstats
+import sys
+from typing import Any, Callable, Coroutine
 
-from .download import resume, start
+from .download import resume, start, update, watch
+from .optimize import Optimizer, background_jobs, check_tools
+from .optimize import optimize_library
+from .trace import Tracer, report
 from .view import run_server
 
 
@@ -19,6 +27,48 @@ except PackageNotFoundError:
     VERSION = "dev"
 
 
+def crawl(args: argparse.Namespace,
+          command: Callable[..., Coroutine[Any, Any, None]],
+          *params: Any) -> None:
+    """Run a crawler command, optionally with tracing or profiling"""
+    with contextlib.ExitStack() as stack:
+        tracer = optimizer = None
+        if args.trace:
+            tracer = stack.enter_context(Tracer(args.trace))
+        if args.optimize:
+            check_tools()
+            optimizer = stack.enter_context(Optimizer(
+                args.optimize_jobs or background_jobs(), args.progressive))
+            stack.callback(logging.info, "Optimization: %s", optimizer.stats)
+        coro = command(*params, tracer=tracer, optimizer=optimizer,
+                       infer=args.infer)
+        if not args.profile:
+            asyncio.run(coro)
+            return
+        # asyncio's debug mode logs callbacks that block the event loop
+        profiler = cProfile.Profile()
+        try:
+            profiler.runcall(asyncio.run, coro, debug=True)
+        finally:
+            stats = pstats.Stats(profiler, stream=sys.stderr)
+            stats.sort_stats("cumulative").print_stats(30)
+
+
+def duration(text: str) -> float:
+    """Parse a duration like 90, 30m, 6h or 1d into seconds"""
+    units = {"s": 1, "m": 60, "h": 60 * 60, "d": 24 * 60 * 60}
+    try:
+        if text[-1:] in units:
+            seconds = float(text[:-1]) * units[text[-1]]
+        else:
+            seconds = float(text)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"invalid duration: {text}")
+    if not 0 < seconds < float("inf"):
+        raise argparse.ArgumentTypeError(f"duration must be positive: {text}")
+    return seconds
+
+
 def main() -> None:
     parser = argparse.ArgumentParser(
         prog=NAME, description="Download manga from some websites")
@@ -27,23 +77,65 @@ def main() -> None:
     parser.add_argument('--version', action='version', version=VERSION)
     subparsers = parser.add_subparsers()
 
-    dl = subparsers.add_parser("download")
-    dl.set_defaults(func=lambda args:
-                    asyncio.run(start(args.url, args.directory, args.jobs)))
+    crawler = argparse.ArgumentParser(add_help=False)
+    crawler.add_argument("--jobs", "-j", type=int, default=3,
+                         help="number of concurrent downloads")
+    crawler.add_argument("--trace", type=Path, metavar="FILE",
+                         help="append a JSON line with timings for every "
+                         "processed job to FILE")
+    crawler.add_argument("--profile", action="store_true",
+                         help="run with cProfile and report slow asyncio "
+                         "callbacks")
+    crawler.add_argument("--optimize", action="store_true",
+                         help="losslessly optimize downloaded images")
+    crawler.add_argument("--infer", action="store_true",
+                         help="learn the image urls of a chapter and skip "
+                         "the html pages where possible")
+
+    optimizer = argparse.ArgumentParser(add_help=False)
+    optimizer.add_argument("--optimize-jobs", type=int, metavar="N",
+                           help="number of processes to optimize images "
+                           "(default: number of CPUs, one less while "
+                           "downloading)")
+    optimizer.add_argument("--progressive", action="store_true",
+                           help="convert JPEG images to progressive")
+
+    dl = subparsers.add_parser("download", parents=[crawler, optimizer])
+    dl.set_defaults(func=lambda args: crawl(
+        args, start, args.url, args.directory, args.jobs))
     dl.add_argument(
         "-d", "--directory", help="the output directory to save files",
         default=Path(), type=Path)
-    dl.add_argument("--jobs", "-j", type=int, default=3,
-                    help="number of concurrent downloads")
     dl.add_argument("url", help="the url to start downloading")
 
-    r = subparsers.add_parser("resume")
-    r.set_defaults(func=lambda args: asyncio.run(resume(args.target, args.jobs)))
-    r.add_argument("--jobs", "-j", type=int, default=3,
-                   help="number of concurrent downloads")
+    r = subparsers.add_parser("resume", parents=[crawler, optimizer])
+    r.set_defaults(func=lambda args: crawl(
+        args, resume, args.target, args.jobs))
     r.add_argument("target", type=Path, nargs="+",
                    help="directories and state files to resume from")
 
+    u = subparsers.add_parser("update", parents=[crawler, optimizer])
+    u.set_defaults(func=lambda args: crawl(
+        args, watch, args.target, args.jobs, args.watch) if args.watch else
+        crawl(args, update, args.target, args.jobs))
+    u.add_argument("--watch", type=duration, metavar="INTERVAL",
+                   help="keep running and check for updates every INTERVAL "
+                   "(seconds or a number with suffix s, m, h or d)")
+    u.add_argument("target", type=Path, nargs="+",
+                   help="comic directories or libraries to check for new "
+                   "chapters")
+
+    opt = subparsers.add_parser("optimize", parents=[optimizer])
+    opt.set_defaults(func=lambda args: optimize_library(
+        args.directory, args.optimize_jobs, args.progressive))
+    opt.add_argument("directory", type=Path, nargs="+",
+                     help="directories with images to optimize")
+
+    tr = subparsers.add_parser("trace-report")
+    tr.set_defaults(func=lambda args: report(args.file))
+    tr.add_argument("file", type=Path, nargs="+",
+                    help="trace files written with --trace")
+
     view = subparsers.add_parser("view")
     view.set_defaults(func=run_server)
     view.add_argument("folder", type=Path)
@@ -3,6 +3,7 @@ A crawler/download script to download mangas and other comics from some websites
 """
 
 import asyncio
+import contextlib
 from dataclasses import dataclass
 import logging
 import os.path
@@ -10,7 +11,7 @@ import pathlib
 import pickle
 import re
 import sys
-from typing import Iterable, Type
+from typing import ContextManager, Iterable, Type
 import urllib.error
 import urllib.parse
 
@@ -18,6 +19,20 @@ import aiohttp
 import bs4
 import urllib3.exceptions
 
+from . import trace
+from .infer import Inference
+from .optimize import Optimizer
+
+
+IMAGE_SIGNATURES = (b"\xff\xd8\xff", b"\x89PNG\r\n\x1a\n", b"GIF87a",
+                    b"GIF89a")
+
+
+def is_image(data: bytes) -> bool:
+    """Check the magic bytes of some image formats"""
+    return data.startswith(IMAGE_SIGNATURES) or (
+        data[:4] == b"RIFF" and data[8:12] == b"WEBP")
+
 
 class Job:
     pass
@@ -70,6 +85,10 @@ class Queue[T]:
     def task_done(self) -> None:
         return self._queue.task_done()
 
+    def mark_done(self, item: T) -> None:
+        """Add an item that does not need to be retrieved from the queue"""
+        self._set.add(item)
+
     def get_state(self) -> dict[T, bool]:
         """Get a dict representation of the internal state
 
@@ -89,28 +108,59 @@ class Site:
 
     DOMAIN: str
     headers: dict[str, str] | None = None
+    tracer: trace.Tracer | None = None
+    optimizer: Optimizer | None = None
+    statefile = 'state.pickle'
+    infer = False
+    # a regex for the urls of pages with one image, see Inference
+    page_pattern: str | None = None
 
     def __init__(self, queue: Queue[Job], directory: pathlib.Path, session: aiohttp.ClientSession):
         self._id = id
         self._session = session
         self.queue = queue
         self.directory = directory
+        self.inference = Inference(self.page_pattern) \
+            if self.page_pattern else None
 
     async def get(self, url: str) -> bytes:
         for _ in range(3):
             try:
-                async with self._session.get(url, headers=self.headers) as req:
+                with trace.phase("ttfb", exclude=("dns", "connect")):
+                    req = await self._session.get(url, headers=self.headers)
+                async with req:
                     req.raise_for_status()
-                    return await req.read()
+                    with trace.phase("body"):
+                        data = await req.read()
+                    trace.add_bytes(len(data))
+                    return data
             except urllib3.exceptions.MaxRetryError as err:
                 logging.warning("Failed to connect: %s\nRetrying  ...", err)
                 await asyncio.sleep(3)
                 continue
         raise urllib3.exceptions.MaxRetryError(None, url)
 
+    async def get_image(self, url: str) -> bytes | None:
+        """Download an image without retrying
+
+        :returns: the data or None if the url does not point to an image
+        """
+        with trace.phase("ttfb", exclude=("dns", "connect")):
+            req = await self._session.get(url, headers=self.headers)
+        async with req:
+            if not req.ok:
+                return None
+            with trace.phase("body"):
+                data = await req.read()
+            trace.add_bytes(len(data))
+            # some servers send images as application/octet-stream
+            if req.content_type.startswith("image/") or is_image(data):
+                return data
+            return None
+
     async def download(self, url: str, path: pathlib.Path) -> None:
         data = await self.get(url)
-        with path.open("wb") as f:
+        with trace.phase("write"), path.open("wb") as f:
             f.write(data)
 
     @staticmethod
@@ -141,6 +191,8 @@ class Site:
         for task in tasks:
             task.cancel()
         await asyncio.gather(*tasks, return_exceptions=True)
+        if self.optimizer:
+            await self.optimizer.join()
         self.dump()
 
     async def run(self, id: int) -> None:
@@ -150,23 +202,52 @@ class Site:
             job: Job = await self.queue.get()
             logging.debug("Worker %s: Processing %s", id, job)
             try:
-                match job:
-                    case PageDownload() as j:
-                        await self.handle_page(j)
-                    case FileDownload() as j:
-                        await self.handle_image(j)
+                with self.trace_job(id, job):
+                    match job:
+                        case PageDownload() as j:
+                            await self.handle_page(j)
+                        case FileDownload() as j:
+                            await self.handle_image(j)
             except Exception as e:
                 logging.exception("Processing of %s failed: %s", job, e)
             self.queue.task_done()
 
+    def trace_job(self, id: int, job: Job) -> ContextManager[object]:
+        """Record a span for the job if tracing is enabled"""
+        if self.tracer is None:
+            return contextlib.nullcontext()
+        if not isinstance(job, (PageDownload, FileDownload)):
+            return contextlib.nullcontext()
+        kind = "page" if isinstance(job, PageDownload) else "file"
+        return self.tracer.span(type(self).__name__, id, kind, job.url)
+
     async def handle_page(self, job: PageDownload) -> None:
+        if self.infer and self.inference:
+            if prediction := self.inference.predict(job.url):
+                url, path = prediction
+                image = FileDownload(url, pathlib.Path(path))
+                if await self.handle_predicted_image(image):
+                    return
+                logging.info("Prediction %s failed, loading %s",
+                             url, job.url)
+                self.inference.fail(job.url)
         page = await self.get(job.url)
         logging.debug("The url %s, returned %s bytes", job, len(page))
-        html = bs4.BeautifulSoup(page, features="lxml")
-        for i in self.extract_pages(html):
-            await self.queue.put(i)
-        for j in self.extract_images(html):
-            await self.queue.put(j)
+        with trace.phase("parse"):
+            html = bs4.BeautifulSoup(page, features="lxml")
+        # queue the pages before extracting the images, they should not get
+        # lost if a page has no image
+        with trace.phase("extract"):
+            for i in self.extract_pages(html):
+                await self.queue.put(i)
+        images = []
+        with trace.phase("extract"):
+            for j in self.extract_images(html):
+                images.append(j)
+                await self.queue.put(j)
+        if self.infer and self.inference:
+            self.inference.observe(
+                job.url, [(image.url, str(image.path)) for image in images])
         logging.info('Finished parsing %s', job.url)
 
     async def handle_image(self, job: FileDownload) -> None:
@@ -183,6 +264,30 @@ class Site:
                                   job.url, filename)
             else:
                 logging.info('Done: %s -> %s', job.url, filename)
+                if self.optimizer:
+                    self.optimizer.submit(filename)
+
+    async def handle_predicted_image(self, job: FileDownload) -> bool:
+        """Download an image that was predicted for a page
+
+        :returns: if the prediction was correct
+        """
+        filename = self.directory / job.path
+        if not filename.exists():
+            try:
+                data = await self.get_image(job.url)
+            except (aiohttp.ClientError, asyncio.TimeoutError):
+                return False
+            if data is None:
+                return False
+            filename.parent.mkdir(parents=True, exist_ok=True)
+            with trace.phase("write"), filename.open("wb") as f:
+                f.write(data)
+            logging.info('Done: %s -> %s (predicted)', job.url, filename)
+            if self.optimizer:
+                self.optimizer.submit(filename)
+        self.queue.mark_done(job)
+        return True
 
     def dump(self) -> None:
         """Dump the internal state of the queue to a file
@@ -191,24 +296,37 @@ class Site:
         continue where this one left of.
         """
         self.directory.mkdir(parents=True, exist_ok=True)
-        filename = self.directory / 'state.pickle'
+        filename = self.directory / self.statefile
         state = self.queue.get_state()
         with filename.open("wb") as fp:
             pickle.dump(state, fp)
 
     @classmethod
-    async def load(cls, directory: pathlib.Path, session: aiohttp.ClientSession) -> "Site":
+    async def load(cls, directory: pathlib.Path,
+                   session: aiohttp.ClientSession,
+                   update: bool = False) -> "Site":
+        """Load a crawler from the state file in the given directory
+
+        :param update: check for new content instead of resuming, this also
+            loads the state of fully downloaded comics (state.pickle.done)
+        """
         statefile = directory / 'state.pickle'
+        if update and not statefile.exists():
+            statefile = directory / 'state.pickle.done'
         with statefile.open("rb") as fp:
             state = pickle.load(fp)
         page = cls.get_resume_page(state)
         crawler = cls.find_crawler(page.url)
-        if crawler.get_resume_page != cls.get_resume_page:
+        if update:
+            page = crawler.get_update_page(state)
+        elif crawler.get_resume_page != cls.get_resume_page:
             page = crawler.get_resume_page(state)
-        state.pop(page)
+        state.pop(page, None)
         queue: Queue[Job] = Queue(state)
         await queue.put(page)
-        return crawler(queue, directory, session)
+        site = crawler(queue, directory, session)
+        site.statefile = statefile.name
+        return site
 
     @staticmethod
     def get_resume_page(state: dict[Job, bool]) -> PageDownload:
@@ -220,6 +338,34 @@ class Site:
             return pages.popitem()[0]
         raise ValueError("Found no page to resume loading.")
 
+    @classmethod
+    def get_update_page(cls, state: dict[Job, bool]) -> PageDownload:
+        """Find the page where new content of a comic shows up
+
+        Only this page is downloaded again when updating a comic, new pages
+        and images that are found on it are added to the queue.
+        """
+        return cls.get_resume_page(state)
+
+    @classmethod
+    def latest_page(cls, state: dict[Job, bool],
+                    pattern: str) -> PageDownload:
+        """Find the first page of the latest chapter in the state
+
+        :param pattern: a regex that matches the urls of chapter pages, the
+            group "chapter" is the chapter number and the optional group
+            "page" the page number (the first page if it is missing)
+        """
+        pages = []
+        for job in state:
+            if isinstance(job, PageDownload):
+                if match := re.search(pattern, job.url):
+                    pages.append((-float(match["chapter"]),
+                                  int(match["page"] or 1), job.url))
+        if pages:
+            return PageDownload(min(pages)[2])
+        return cls.get_resume_page(state)
+
 
 class Islieb(Site):
 
@@ -249,6 +395,7 @@ class Islieb(Site):
 class MangaReader(Site):
 
     DOMAIN = "www.mangareader.net"
+    page_pattern = r"^(?P<chapter>https://[^/]+/[^/]+/\d+)(?:/(?P<page>\d+))?$"
 
     @staticmethod
     def extract_images(html: bs4.BeautifulSoup) -> Iterable[FileDownload]:
@@ -269,10 +416,17 @@ class MangaReader(Site):
         for path in pages + chapters:
             yield PageDownload("https://" + cls.DOMAIN + path)
 
+    @classmethod
+    def get_update_page(cls, state: dict[Job, bool]) -> PageDownload:
+        return cls.latest_page(state, r"^https://[^/]+/[^/]+/"
+                               r"(?P<chapter>\d+)(?:/(?P<page>\d+))?$")
+
 
 class MangaTown(Site):
 
     DOMAIN = "www.mangatown.com"
+    page_pattern = (r"^(?P<chapter>https://[^/]+/manga/[^/]+/c[\d.]+/)"
+                    r"(?:(?P<page>\d+)\.html)?$")
 
     def __init__(self, queue: Queue[Job], directory: pathlib.Path, session: aiohttp.ClientSession):
         super().__init__(queue,  directory, session)
@@ -301,6 +455,11 @@ class MangaTown(Site):
         return tag.name == "img" and ("image" in tag.get("class", []) or
                                       tag.get("id") == "image")
 
+    @classmethod
+    def get_update_page(cls, state: dict[Job, bool]) -> PageDownload:
+        return cls.latest_page(
+            state, r"/c(?P<chapter>\d+(?:\.\d+)?)/(?:(?P<page>\d+)\.html)?$")
+
 
 class ReadMangaBat(Site):
     DOMAIN = "readmangabat.com"
@@ -329,6 +488,7 @@ class ReadMangaBat(Site):
 class Taadd(Site):
 
     DOMAIN = "www.taadd.com"
+    page_pattern = r"^(?P<chapter>.*/\d+)(?:/|-(?P<page>\d+)\.html)$"
 
     @staticmethod
     def intpad(i: int, n: int) -> str:
@@ -362,6 +522,11 @@ class Taadd(Site):
         for opt in html.find("select", id="page").find_all("option"):
             yield PageDownload(opt["value"])
 
+    @classmethod
+    def get_update_page(cls, state: dict[Job, bool]) -> PageDownload:
+        return cls.latest_page(
+            state, r"/(?P<chapter>\d+)(?:/|-(?P<page>\d+)\.html)$")
+
 
 class Xkcd(Site):
 
@@ -385,12 +550,25 @@ class Xkcd(Site):
         else:
             yield PageDownload("https://" + cls.DOMAIN + "/")
 
+    @classmethod
+    def get_update_page(cls, state: dict[Job, bool]) -> PageDownload:
+        # the front page links to all comics up to the latest one
+        return PageDownload("https://" + cls.DOMAIN + "/")
+
 
-async def start(url: str, directory: pathlib.Path, jobs: int) -> None:
+def trace_configs(tracer: trace.Tracer | None) -> list[aiohttp.TraceConfig]:
+    return [tracer.trace_config()] if tracer else []
+
+
+async def start(url: str, directory: pathlib.Path, jobs: int,
+                tracer: trace.Tracer | None = None,
+                optimizer: Optimizer | None = None,
+                infer: bool = False) -> None:
     if (directory / "state.pickle").exists():
         sys.exit(f"A state file exists in {directory}, "
                  "please use 'resume' instead of 'download'")
-    async with aiohttp.ClientSession() as session:
+    async with aiohttp.ClientSession(
+            trace_configs=trace_configs(tracer)) as session:
         try:
             Crawler = Site.find_crawler(url)
         except NotImplementedError as err:
@@ -398,11 +576,18 @@ async def start(url: str, directory: pathlib.Path, jobs: int) -> None:
         queue: Queue[Job] = Queue()
         await queue.put(PageDownload(url))
         crawler = Crawler(queue, directory, session)
+        crawler.tracer = tracer
+        crawler.optimizer = optimizer
+        crawler.infer = infer
         await crawler.start(jobs)
 
 
-async def resume(targets: list[pathlib.Path], jobs: int) -> None:
-    async with aiohttp.ClientSession() as session:
+async def resume(targets: list[pathlib.Path], jobs: int,
+                 tracer: trace.Tracer | None = None,
+                 optimizer: Optimizer | None = None,
+                 infer: bool = False) -> None:
+    async with aiohttp.ClientSession(
+            trace_configs=trace_configs(tracer)) as session:
         tasks = []
         for target in targets:
             if (target / "state.pickle.done").exists():
@@ -410,6 +595,9 @@ async def resume(targets: list[pathlib.Path], jobs: int) -> None:
                 continue
             try:
                 crawler = await Site.load(target, session)
+                crawler.tracer = tracer
+                crawler.optimizer = optimizer
+                crawler.infer = infer
                 tasks.append(crawler.start(jobs))
             except NotImplementedError as err:
                 logging.error("%s, resumed from %s", err, target)
@@ -417,3 +605,48 @@ async def resume(targets: list[pathlib.Path], jobs: int) -> None:
                 logging.error("No state file found in %s to resume from", target)
         logging.debug("Starting the crawlers ...")
         await asyncio.gather(*tasks, return_exceptions=True)
+
+
+def find_comics(targets: list[pathlib.Path]) -> list[pathlib.Path]:
+    """Find all directories with state files below the given directories"""
+    return sorted({state.parent for target in targets
+                   for state in target.glob("**/state.pickle*")
+                   if state.name in ("state.pickle", "state.pickle.done")})
+
+
+async def update(targets: list[pathlib.Path], jobs: int,
+                 tracer: trace.Tracer | None = None,
+                 optimizer: Optimizer | None = None,
+                 infer: bool = False) -> None:
+    async with aiohttp.ClientSession(
+            trace_configs=trace_configs(tracer)) as session:
+        tasks = []
+        for directory in find_comics(targets):
+            try:
+                crawler = await Site.load(directory, session, update=True)
+                crawler.tracer = tracer
+                crawler.optimizer = optimizer
+                crawler.infer = infer
+                tasks.append(crawler.start(jobs))
+            except NotImplementedError as err:
+                logging.error("%s, updated from %s", err, directory)
+            except FileNotFoundError:
+                logging.error("No state file found in %s to update from",
+                              directory)
+            except (ValueError, EOFError, pickle.UnpicklingError) as err:
+                logging.error("Invalid state file in %s: %s", directory, err)
+        logging.debug("Checking %s comics for updates ...", len(tasks))
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+
+async def watch(targets: list[pathlib.Path], jobs: int, interval: float,
+                tracer: trace.Tracer | None = None,
+                optimizer: Optimizer | None = None,
+                infer: bool = False) -> None:
+    while True:
+        try:
+            await update(targets, jobs, tracer, optimizer, infer)
+        except Exception as err:
+            logging.exception("Update failed: %s", err)
+        logging.info("Next update in %s seconds", interval)
+        await asyncio.sleep(interval)
@@ -0,0 +1,127 @@
+"""
+Inference of image urls for sites that show one image per page.
+
+After a few pages of a chapter were downloaded the url and the file name of
+the images usually only differ in one number that grows with the page number
+(e.g. .../compressed/v000.jpg, v001.jpg, ...).  Once such a pattern is found
+the images of the remaining pages can be requested directly, without fetching
+and parsing the html page first.
+"""
+
+from collections import defaultdict
+from dataclasses import dataclass
+import re
+
+
+@dataclass(frozen=True)
+class Template:
+    """A string with one number that grows with the page number"""
+
+    prefix: str
+    offset: int
+    width: int
+    suffix: str
+
+    def format(self, page: int) -> str:
+        number = str(page + self.offset).zfill(self.width)
+        return self.prefix + number + self.suffix
+
+    @classmethod
+    def infer(cls, samples: dict[int, str]) -> "Template | None":
+        """Find a template that produces all samples
+
+        :param samples: the known strings by page number
+        :returns: the template or None if the samples do not fit a template
+        """
+        pages = sorted(samples)
+        # odd indices are the numbers and even indices the text between them
+        tokens = [re.split(r"(\d+)", samples[page]) for page in pages]
+        if len({len(t) for t in tokens}) != 1:
+            return None
+        varying = [i for i in range(len(tokens[0]))
+                   if len({t[i] for t in tokens}) > 1]
+        if len(varying) != 1 or varying[0] % 2 == 0:
+            return None
+        i = varying[0]
+        first = tokens[0]
+        width = len(first[i]) if first[i].startswith("0") else 1
+        template = cls("".join(first[:i]), int(first[i]) - pages[0], width,
+                       "".join(first[i+1:]))
+        if all(template.format(page) == samples[page] for page in pages):
+            return template
+        return None
+
+
+class Inference:
+    """Learn and predict the image of every page in a chapter
+
+    :param pattern: a regex that matches the urls of the pages, the group
+        "chapter" identifies the chapter and the optional group "page" is the
+        page number (the first page if it is missing)
+    """
+
+    SAMPLES = 3
+
+    def __init__(self, pattern: str) -> None:
+        self.pattern = re.compile(pattern)
+        self._samples: dict[str, dict[int, tuple[str, str]]] = \
+            defaultdict(dict)
+        self._templates: dict[str, tuple[Template, Template]] = {}
+        # chapters with several images per page or a wrong prediction
+        self._ignored: set[str] = set()
+
+    def page(self, url: str) -> tuple[str, int] | None:
+        if match := self.pattern.match(url):
+            return match["chapter"], int(match["page"] or 1)
+        return None
+
+    def observe(self, url: str, images: list[tuple[str, str]]) -> None:
+        """Record the images that were found on a downloaded page
+
+        :param url: the url of the page
+        :param images: the urls and file paths of the images on the page
+        """
+        if (page := self.page(url)) is None or page[0] in self._ignored:
+            return
+        chapter, number = page
+        if len(images) != 1:
+            self.fail(url)
+            return
+        if chapter in self._templates:
+            if self.predict(url) != images[0]:
+                self.fail(url)
+            return
+        samples = self._samples[chapter]
+        samples.pop(number, None)
+        samples[number] = images[0]
+        if len(samples) >= self.SAMPLES:
+            # only the latest pages count, an odd page (e.g. credits) should
+            # not spoil the pattern for the rest of the chapter
+            latest = list(samples.items())[-self.SAMPLES:]
+            urls = Template.infer({p: u for p, (u, _) in latest})
+            paths = Template.infer({p: f for p, (_, f) in latest})
+            if urls and paths:
+                self._templates[chapter] = urls, paths
+
+    def predict(self, url: str) -> tuple[str, str] | None:
+        """Predict the image url and file path for a page
+
+        :returns: the url and path or None if there is no prediction
+        """
+        if (page := self.page(url)) is None:
+            return None
+        chapter, number = page
+        if templates := self._templates.get(chapter):
+            return templates[0].format(number), templates[1].format(number)
+        return None
+
+    def fail(self, url: str) -> None:
+        """Stop predicting images for the chapter of the given page
+
+        The remaining pages of the chapter are loaded normally, so that a
+        pattern that never works costs at most one request.
+        """
+        if page := self.page(url):
+            self._ignored.add(page[0])
+            self._templates.pop(page[0], None)
+            self._samples.pop(page[0], None)
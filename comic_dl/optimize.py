@@ -0,0 +1,213 @@
+"""
+Lossless optimization of downloaded images.
+
+JPEG files are rewritten with jpegtran (optimized Huffman tables and
+optionally progressive encoding) and PNG files are recompressed with optipng.
+Both tools decode the whole image so they also serve as an integrity check.
+The work is done in a process pool so that it does not block the crawler.
+"""
+
+import asyncio
+from concurrent.futures import Future, ProcessPoolExecutor
+from dataclasses import dataclass
+import functools
+import logging
+import multiprocessing
+import os
+import pathlib
+import shutil
+import subprocess
+import sys
+from typing import Iterable, Iterator
+
+
+JPEG = b"\xff\xd8\xff"
+PNG = b"\x89PNG\r\n\x1a\n"
+SUFFIXES = {".jpg", ".jpeg", ".png"}
+TOOLS = ["jpegtran", "optipng"]
+
+
+@dataclass(frozen=True)
+class Result:
+    path: pathlib.Path
+    before: int
+    after: int
+    error: str | None = None
+    skipped: bool = False
+
+
+@dataclass
+class Stats:
+    files: int = 0
+    optimized: int = 0
+    failed: int = 0
+    skipped: int = 0
+    before: int = 0
+    after: int = 0
+
+    def add(self, result: Result) -> None:
+        if result.skipped:
+            self.skipped += 1
+            return
+        self.files += 1
+        self.before += result.before
+        self.after += result.after
+        if result.error:
+            self.failed += 1
+        elif result.after < result.before:
+            self.optimized += 1
+
+    def __str__(self) -> str:
+        saved = self.before - self.after
+        percent = 100 * saved / self.before if self.before else 0
+        return (f"{self.files} images checked, {self.optimized} optimized, "
+                f"{self.failed} failed, {self.skipped} skipped, "
+                f"saved {saved} bytes ({percent:.1f}%)")
+
+
+def check_tools() -> None:
+    """Exit if the external programs for the optimization are missing"""
+    if missing := [tool for tool in TOOLS if shutil.which(tool) is None]:
+        sys.exit(f"Image optimization needs {' and '.join(missing)}, "
+                 "please install libjpeg-turbo and optipng")
+
+
+def background_jobs() -> int:
+    """The number of processes for the optimization during a download
+
+    One cpu is left for the event loop that also parses the html pages.
+    """
+    return max(1, (os.cpu_count() or 1) - 1)
+
+
+def command(path: pathlib.Path, out: pathlib.Path,
+            progressive: bool = False) -> list[str] | None:
+    """Find the command to optimize the given image
+
+    :returns: the command line or None if the file type is not supported
+    """
+    with path.open("rb") as fp:
+        magic = fp.read(len(PNG))
+    if magic.startswith(JPEG):
+        extra = ["-progressive"] if progressive else []
+        return ["jpegtran", "-copy", "all", "-optimize", *extra,
+                "-outfile", str(out), str(path)]
+    if magic.startswith(PNG):
+        return ["optipng", "-quiet", "-o2", "-clobber", "-out", str(out),
+                str(path)]
+    return None
+
+
+def optimize(path: pathlib.Path, progressive: bool = False) -> Result:
+    """Losslessly optimize an image in place
+
+    The file is only replaced if the optimized version is smaller.  If the
+    image is corrupt it is left untouched and the error is reported in the
+    result.
+    """
+    before = path.stat().st_size
+    tmp = path.with_name(f".{path.name}.tmp")
+    try:
+        cmd = command(path, tmp, progressive)
+        if cmd is None:
+            return Result(path, before, before, skipped=True)
+        proc = subprocess.run(cmd, capture_output=True, text=True)
+        if proc.returncode != 0:
+            return Result(path, before, before,
+                          proc.stderr.strip() or f"{cmd[0]} failed")
+        after = tmp.stat().st_size
+        if 0 < after < before:
+            tmp.replace(path)
+            return Result(path, before, after)
+        return Result(path, before, before)
+    except OSError as err:
+        return Result(path, before, before, str(err))
+    finally:
+        tmp.unlink(missing_ok=True)
+
+
+def find_images(directories: Iterable[pathlib.Path]
+                ) -> Iterator[pathlib.Path]:
+    for directory in directories:
+        for path in sorted(directory.rglob("*")):
+            if path.suffix.lower() in SUFFIXES and path.is_file():
+                yield path
+
+
+class Optimizer:
+    """Optimize downloaded images in a bounded process pool
+
+    Images are submitted from the crawler and processed in the background,
+    the crawler only has to wait for them before it finishes.
+    """
+
+    def __init__(self, jobs: int | None = None,
+                 progressive: bool = False) -> None:
+        self.jobs = jobs
+        self.progressive = progressive
+        self.stats = Stats()
+        self._pool: ProcessPoolExecutor | None = None
+        self._pending: set[asyncio.Future[Result]] = set()
+
+    def __enter__(self) -> "Optimizer":
+        self._pool = ProcessPoolExecutor(
+            self.jobs, mp_context=multiprocessing.get_context("forkserver"))
+        return self
+
+    def __exit__(self, *exc: object) -> None:
+        if self._pool is not None:
+            self._pool.shutdown(cancel_futures=True)
+            self._pool = None
+
+    def submit(self, path: pathlib.Path) -> None:
+        assert self._pool is not None, "The optimizer is not running"
+        if path.suffix.lower() not in SUFFIXES:
+            return
+        loop = asyncio.get_running_loop()
+        future = loop.run_in_executor(
+            self._pool, optimize, path, self.progressive)
+        self._pending.add(future)
+        future.add_done_callback(self._done)
+
+    def _done(self, future: "asyncio.Future[Result] | Future[Result]"
+              ) -> None:
+        if isinstance(future, asyncio.Future):
+            self._pending.discard(future)
+        if future.cancelled():
+            return
+        if err := future.exception():
+            logging.error("Optimization failed: %s", err)
+            return
+        result = future.result()
+        self.stats.add(result)
+        if result.skipped:
+            logging.debug("Skipped %s: unsupported file type", result.path)
+        elif result.error:
+            logging.error("Could not optimize %s: %s",
+                          result.path, result.error)
+        elif result.after < result.before:
+            logging.debug("Optimized %s: %s -> %s bytes",
+                          result.path, result.before, result.after)
+
+    async def join(self) -> None:
+        """Wait for all submitted images to be processed"""
+        while self._pending:
+            await asyncio.gather(*self._pending, return_exceptions=True)
+
+    def run(self, directories: Iterable[pathlib.Path]) -> Stats:
+        """Optimize all images below the given directories"""
+        assert self._pool is not None, "The optimizer is not running"
+        worker = functools.partial(optimize, progressive=self.progressive)
+        futures = [self._pool.submit(worker, path)
+                   for path in find_images(directories)]
+        for future in futures:
+            self._done(future)
+        return self.stats
+
+
+def optimize_library(directories: list[pathlib.Path], jobs: int | None,
+                     progressive: bool) -> None:
+    check_tools()
+    with Optimizer(jobs, progressive) as optimizer:
+        stats = optimizer.run(directories)
+    print(stats)
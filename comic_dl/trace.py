@@ -0,0 +1,195 @@
+"""
+Per job tracing for the crawler.
+
+Every job that a worker processes can be recorded as a span with the time
+spent in the different phases of the job (dns lookup, connecting, waiting for
+the first byte, transferring the body, parsing, extracting and writing to
+disk).  The spans are written as JSON lines to a file and can be summarized
+with report().
+"""
+
+from collections import defaultdict
+import contextlib
+import contextvars
+from dataclasses import asdict, dataclass, field
+import json
+import math
+import pathlib
+import sys
+import time
+from types import SimpleNamespace
+from typing import Any, Iterable, Iterator, TextIO
+import urllib.parse
+
+import aiohttp
+
+
+@dataclass
+class Span:
+    site: str
+    worker: int
+    kind: str
+    url: str
+    host: str
+    start: float
+    duration: float = 0.0
+    bytes: int = 0
+    error: str | None = None
+    phases: dict[str, float] = field(default_factory=dict)
+
+    def add(self, phase: str, seconds: float) -> None:
+        self.phases[phase] = self.phases.get(phase, 0.0) + seconds
+
+
+# The span of the job that the current worker task is processing.  Every
+# worker runs in its own task so each one sees its own span.
+current_span: contextvars.ContextVar[Span | None] = contextvars.ContextVar(
+    "current_span", default=None)
+
+
+@contextlib.contextmanager
+def phase(name: str, exclude: Iterable[str] = ()) -> Iterator[None]:
+    """Time the enclosed block as a phase of the current span
+
+    :param name: the name of the phase
+    :param exclude: phases that might be recorded while the block is
+        running, their time is subtracted from this phase
+    """
+    span = current_span.get()
+    if span is None:
+        yield
+        return
+    exclude = tuple(exclude)
+    before = sum(span.phases.get(p, 0.0) for p in exclude)
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - start
+        nested = sum(span.phases.get(p, 0.0) for p in exclude) - before
+        span.add(name, max(elapsed - nested, 0.0))
+
+
+def add_bytes(count: int) -> None:
+    if span := current_span.get():
+        span.bytes += count
+
+
+class Tracer:
+    """Write a JSON line for every traced job to a file"""
+
+    def __init__(self, path: pathlib.Path) -> None:
+        self.path = path
+        self._file: TextIO | None = None
+
+    def __enter__(self) -> "Tracer":
+        self._file = self.path.open("a", buffering=1)
+        return self
+
+    def __exit__(self, *exc: object) -> None:
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    @contextlib.contextmanager
+    def span(self, site: str, worker: int, kind: str,
+             url: str) -> Iterator[Span]:
+        span = Span(site, worker, kind, url,
+                    urllib.parse.urlsplit(url).hostname or "", time.time())
+        token = current_span.set(span)
+        start = time.perf_counter()
+        try:
+            yield span
+        except BaseException as err:
+            span.error = repr(err)
+            raise
+        finally:
+            span.duration = time.perf_counter() - start
+            current_span.reset(token)
+            self.write(span)
+
+    def write(self, span: Span) -> None:
+        if self._file is not None:
+            self._file.write(json.dumps(asdict(span)) + "\n")
+
+    @staticmethod
+    def trace_config() -> aiohttp.TraceConfig:
+        """Create a trace config that records dns and connect phases
+
+        The config has to be passed to the aiohttp.ClientSession that the
+        crawler uses.
+        """
+        config = aiohttp.TraceConfig()
+
+        async def dns_start(session: aiohttp.ClientSession,
+                            ctx: SimpleNamespace, params: Any) -> None:
+            ctx.dns_start = time.perf_counter()
+
+        async def dns_end(session: aiohttp.ClientSession,
+                          ctx: SimpleNamespace, params: Any) -> None:
+            if span := current_span.get():
+                span.add("dns", time.perf_counter() - ctx.dns_start)
+
+        async def connect_start(session: aiohttp.ClientSession,
+                                ctx: SimpleNamespace, params: Any) -> None:
+            ctx.connect_start = time.perf_counter()
+            span = current_span.get()
+            ctx.dns = span.phases.get("dns", 0.0) if span else 0.0
+
+        async def connect_end(session: aiohttp.ClientSession,
+                              ctx: SimpleNamespace, params: Any) -> None:
+            # the dns lookup happens while the connection is created
+            if span := current_span.get():
+                dns = span.phases.get("dns", 0.0) - ctx.dns
+                span.add("connect",
+                         time.perf_counter() - ctx.connect_start - dns)
+
+        config.on_dns_resolvehost_start.append(dns_start)
+        config.on_dns_resolvehost_end.append(dns_end)
+        config.on_connection_create_start.append(connect_start)
+        config.on_connection_create_end.append(connect_end)
+        return config
+
+
+def percentile(values: list[float], p: float) -> float:
+    """Compute the p-th percentile of the values (nearest rank method)"""
+    if not values:
+        return 0.0
+    values = sorted(values)
+    rank = max(math.ceil(p * len(values) / 100), 1)
+    return values[rank - 1]
+
+
+def load(path: pathlib.Path) -> list[dict[str, Any]]:
+    with path.open() as fp:
+        return [json.loads(line) for line in fp if line.strip()]
+
+
+def summarize(spans: list[dict[str, Any]]
+              ) -> dict[str, dict[str, list[float]]]:
+    """Group the durations of the spans by site, host and phase"""
+    groups: dict[str, dict[str, list[float]]] = {
+        "site": defaultdict(list), "host": defaultdict(list),
+        "phase": defaultdict(list)}
+    for span in spans:
+        groups["site"][span["site"]].append(span["duration"])
+        groups["host"][span["host"]].append(span["duration"])
+        for name, seconds in span["phases"].items():
+            groups["phase"][name].append(seconds)
+    return groups
+
+
+def report(paths: list[pathlib.Path], out: TextIO = sys.stdout) -> None:
+    """Print percentiles for the spans in the given trace files"""
+    spans = [span for path in paths for span in load(path)]
+    errors = sum(1 for span in spans if span["error"])
+    size = sum(span["bytes"] for span in spans)
+    print(f"{len(spans)} jobs, {errors} errors, {size} bytes", file=out)
+    header = f"{'':30} {'count':>7}" + "".join(
+        f" {p:>9}" for p in ("p50", "p90", "p99", "max"))
+    for group, durations in summarize(spans).items():
+        print(f"\nper {group}:\n{header}", file=out)
+        for key, values in sorted(durations.items()):
+            stats = " ".join(f"{percentile(values, p):9.3f}"
+                             for p in (50, 90, 99, 100))
+            print(f"{key[:30]:30} {len(values):7} {stats}", file=out)
@@ -20,6 +20,10 @@
       pyproject = true;
       src = ./.;
       propagatedBuildInputs = deps;
+      # external tools for the image optimization
+      makeWrapperArgs = [
+        "--prefix PATH : ${pkgs.lib.makeBinPath [ pkgs.libjpeg pkgs.optipng ]}"
+      ];
       checkPhase = "python -m unittest";
     };
 
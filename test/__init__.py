@@ -1,10 +1,24 @@
+import argparse
+import asyncio
+import dataclasses
+import io
+import json
 import pathlib
+import pickle
+import shutil
+import subprocess
+import tempfile
 import unittest
+import unittest.mock
 
+import aiohttp
 import bs4
 
-from comic_dl.download import ReadMangaBat, PageDownload, FileDownload
+from comic_dl.download import ReadMangaBat, PageDownload, FileDownload, Site
+from comic_dl.download import Queue
 from comic_dl.download import Islieb, MangaReader, MangaTown, Taadd, Xkcd
+from comic_dl import download, duration, optimize, trace
+from comic_dl.infer import Inference, Template
 
 
 def load_html(name):
@@ -190,3 +204,468 @@ class StaticParserTests(unittest.TestCase):
                     for i in range(1, 2228) if i != 404]
         actual = list(Xkcd.extract_pages(html))
         self.assertListEqual(actual, expected)
+
+
+class TraceTests(unittest.TestCase):
+
+    def test_percentile(self):
+        values = [float(i) for i in range(1, 101)]
+        self.assertEqual(trace.percentile(values, 50), 50.0)
+        self.assertEqual(trace.percentile(values, 99), 99.0)
+        self.assertEqual(trace.percentile(values, 100), 100.0)
+        self.assertEqual(trace.percentile([3.0], 90), 3.0)
+        self.assertEqual(trace.percentile([], 50), 0.0)
+
+    def test_phases_are_recorded_in_spans(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            path = pathlib.Path(tmp) / "trace.jsonl"
+            with trace.Tracer(path) as tracer:
+                with tracer.span("Xkcd", 2, "page", "https://xkcd.com/1/"):
+                    with trace.phase("parse"):
+                        pass
+                    trace.add_bytes(42)
+            [span] = trace.load(path)
+        self.assertEqual(span["site"], "Xkcd")
+        self.assertEqual(span["host"], "xkcd.com")
+        self.assertEqual(span["worker"], 2)
+        self.assertEqual(span["bytes"], 42)
+        self.assertIn("parse", span["phases"])
+        self.assertIsNone(span["error"])
+
+    def test_phase_without_span(self):
+        with trace.phase("parse"):
+            trace.add_bytes(1)
+        self.assertIsNone(trace.current_span.get())
+
+    def test_report(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            path = pathlib.Path(tmp) / "trace.jsonl"
+            with path.open("w") as fp:
+                for i in range(4):
+                    span = trace.Span("Taadd", i, "file", "", "pic.taadd.com",
+                                      0, duration=i, bytes=10,
+                                      phases={"body": i / 2})
+                    fp.write(json.dumps(dataclasses.asdict(span)) + "\n")
+            out = io.StringIO()
+            trace.report([path], out)
+        lines = out.getvalue().splitlines()
+        self.assertEqual(lines[0], "4 jobs, 0 errors, 40 bytes")
+        self.assertIn("per phase:", lines)
+        self.assertTrue(any(line.startswith("Taadd ") for line in lines))
+
+
+class OptimizeTests(unittest.TestCase):
+
+    def setUp(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.dir = pathlib.Path(tmp.name)
+
+    def test_command_depends_on_file_content(self):
+        jpeg = self.dir / "a.png"
+        jpeg.write_bytes(optimize.JPEG + b"data")
+        png = self.dir / "b.jpg"
+        png.write_bytes(optimize.PNG + b"data")
+        text = self.dir / "c.jpg"
+        text.write_bytes(b"<html>")
+        out = self.dir / "out"
+        self.assertEqual(optimize.command(jpeg, out, True)[:5],
+                         ["jpegtran", "-copy", "all", "-optimize",
+                          "-progressive"])
+        self.assertEqual(optimize.command(png, out)[0], "optipng")
+        self.assertIsNone(optimize.command(text, out))
+
+    def test_unsupported_files_are_not_touched(self):
+        path = self.dir / "broken.jpg"
+        path.write_bytes(b"<html>")
+        result = optimize.optimize(path)
+        self.assertTrue(result.skipped)
+        self.assertIsNone(result.error)
+        self.assertEqual(path.read_bytes(), b"<html>")
+        self.assertEqual([p.name for p in self.dir.iterdir()], ["broken.jpg"])
+
+    def test_find_images(self):
+        for name in ["1/a.JPG", "1/b.png", "2/c.jpeg", "state.pickle"]:
+            (self.dir / name).parent.mkdir(exist_ok=True)
+            (self.dir / name).touch()
+        actual = [p.relative_to(self.dir)
+                  for p in optimize.find_images([self.dir])]
+        expected = [pathlib.Path(p)
+                    for p in ["1/a.JPG", "1/b.png", "2/c.jpeg"]]
+        self.assertListEqual(actual, expected)
+
+    def test_stats(self):
+        stats = optimize.Stats()
+        stats.add(optimize.Result(pathlib.Path("a"), 100, 80))
+        stats.add(optimize.Result(pathlib.Path("b"), 100, 100))
+        stats.add(optimize.Result(pathlib.Path("c"), 50, 50, "corrupt"))
+        stats.add(optimize.Result(pathlib.Path("d"), 10, 10, skipped=True))
+        self.assertEqual(str(stats), "3 images checked, 1 optimized, "
+                         "1 failed, 1 skipped, saved 20 bytes (8.0%)")
+
+    def test_background_jobs_leave_a_cpu_free(self):
+        for cpus, jobs in [(8, 7), (2, 1), (1, 1), (None, 1)]:
+            with unittest.mock.patch("os.cpu_count", return_value=cpus):
+                self.assertEqual(optimize.background_jobs(), jobs)
+
+    def test_missing_tools(self):
+        with unittest.mock.patch("shutil.which", return_value=None):
+            with self.assertRaises(SystemExit) as cm:
+                optimize.check_tools()
+        self.assertIn("jpegtran and optipng", str(cm.exception))
+
+    def test_optimizer_run(self):
+        (self.dir / "1").mkdir()
+        (self.dir / "1" / "page.jpg").write_bytes(b"<html>")
+        (self.dir / "1" / "anim.gif").write_bytes(b"GIF89a")
+        with optimize.Optimizer(2) as optimizer:
+            stats = optimizer.run([self.dir])
+        self.assertEqual(stats, optimize.Stats(skipped=1))
+        self.assertEqual((self.dir / "1" / "page.jpg").read_bytes(),
+                         b"<html>")
+
+    def test_optimizer_submit(self):
+        for name in ["page.jpg", "anim.gif"]:
+            (self.dir / name).write_bytes(b"<html>")
+
+        async def submit(optimizer):
+            optimizer.submit(self.dir / "page.jpg")
+            optimizer.submit(self.dir / "anim.gif")
+            await optimizer.join()
+
+        with optimize.Optimizer(1) as optimizer:
+            asyncio.run(submit(optimizer))
+        self.assertEqual(optimizer.stats, optimize.Stats(skipped=1))
+
+    @unittest.skipUnless(shutil.which("jpegtran") and shutil.which("cjpeg"),
+                         "needs jpegtran and cjpeg")
+    def test_optimize_jpeg(self):
+        ppm = self.dir / "image.ppm"
+        pixels = bytes((x * y + x) % 256
+                       for y in range(64) for x in range(3 * 64))
+        ppm.write_bytes(b"P6 64 64 255\n" + pixels)
+        jpeg = self.dir / "image.jpg"
+        subprocess.run(["cjpeg", "-outfile", str(jpeg), str(ppm)], check=True)
+        data = jpeg.read_bytes()
+        truncated = self.dir / "truncated.jpg"
+        truncated.write_bytes(data[:len(data) // 2])
+
+        result = optimize.optimize(jpeg)
+        self.assertIsNone(result.error)
+        self.assertLess(result.after, result.before)
+        self.assertEqual(jpeg.stat().st_size, result.after)
+        result = optimize.optimize(truncated)
+        self.assertIsNotNone(result.error)
+        self.assertEqual(truncated.read_bytes(), data[:len(data) // 2])
+
+
+class UpdateTests(unittest.TestCase):
+
+    def test_mangatown_update_page_is_in_latest_chapter(self):
+        base = "https://www.mangatown.com/manga/azumi/"
+        state = {PageDownload(base + "c264/2.html"): True,
+                 PageDownload(base + "c009/"): True,
+                 PageDownload(base + "c264.5/"): True,
+                 PageDownload(base + "c010/3.html"): True}
+        self.assertEqual(MangaTown.get_update_page(state),
+                         PageDownload(base + "c264.5/"))
+
+    def test_taadd_update_page_is_in_latest_chapter(self):
+        base = "https://www.taadd.com/chapter/BattleAngelAlitaLastOrder"
+        state = {PageDownload(base + "1/487056/"): True,
+                 PageDownload(base + "2/487061-3.html"): True,
+                 PageDownload(base + "10/487100/"): True,
+                 FileDownload(base + "99/999999/", pathlib.Path()): True}
+        self.assertEqual(Taadd.get_update_page(state),
+                         PageDownload(base + "10/487100/"))
+
+    def test_update_page_does_not_depend_on_the_order(self):
+        base = "https://www.mangatown.com/manga/azumi/"
+        pages = [PageDownload(base + "c282/featured.html"),
+                 PageDownload(base + "c281/")] + [
+            PageDownload(base + f"c282/{i}.html") for i in range(2, 26)]
+        for order in [pages, pages[::-1], pages[5:] + pages[:5]]:
+            state = dict.fromkeys(order, True)
+            self.assertEqual(MangaTown.get_update_page(state),
+                             PageDownload(base + "c282/2.html"))
+        state[PageDownload(base + "c282/")] = True
+        self.assertEqual(MangaTown.get_update_page(state),
+                         PageDownload(base + "c282/"))
+        base = "https://www.taadd.com/chapter/BattleAngelAlitaLastOrder10/"
+        pages = [PageDownload(base + f"487100-{i}.html") for i in range(1, 9)]
+        for order in [pages, pages[::-1]]:
+            self.assertEqual(Taadd.get_update_page(dict.fromkeys(order, True)),
+                             PageDownload(base + "487100-1.html"))
+
+    def test_xkcd_update_page_is_the_front_page(self):
+        state = {PageDownload("https://xkcd.com/{}/".format(i)): True
+                 for i in range(1, 10)}
+        self.assertEqual(Xkcd.get_update_page(state),
+                         PageDownload("https://xkcd.com/"))
+
+    def test_find_comics(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            library = pathlib.Path(tmp)
+            for name in ["a/state.pickle", "b/c/state.pickle.done",
+                         "d/state.pickle.bak"]:
+                (library / name).parent.mkdir(parents=True)
+                (library / name).touch()
+            self.assertEqual(download.find_comics([library]),
+                             [library / "a", library / "b" / "c"])
+
+    def test_broken_comics_do_not_stop_the_update(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            library = pathlib.Path(tmp)
+            for name, data in [("empty", pickle.dumps({})),
+                               ("garbled", b"no pickle"), ("truncated", b"")]:
+                (library / name).mkdir()
+                (library / name / "state.pickle").write_bytes(data)
+            with self.assertLogs(level="ERROR") as logs:
+                asyncio.run(download.update([library], 1))
+        self.assertEqual(len(logs.records), 3)
+
+    def test_watch_continues_after_a_failed_update(self):
+        class Stop(BaseException):
+            pass
+        update = unittest.mock.AsyncMock(side_effect=[RuntimeError, None])
+        sleep = unittest.mock.AsyncMock(side_effect=[None, Stop])
+        with unittest.mock.patch.object(download, "update", update), \
+                unittest.mock.patch.object(download.asyncio, "sleep", sleep), \
+                self.assertLogs(level="ERROR"), self.assertRaises(Stop):
+            asyncio.run(download.watch([pathlib.Path()], 1, 60))
+        self.assertEqual(update.await_count, 2)
+        sleep.assert_awaited_with(60)
+
+    def test_duration(self):
+        self.assertEqual(duration("90"), 90)
+        self.assertEqual(duration("30m"), 30 * 60)
+        self.assertEqual(duration("1.5h"), 90 * 60)
+        for text in ["0", "-5m", "2x", "inf", "nan"]:
+            with self.assertRaises(argparse.ArgumentTypeError):
+                duration(text)
+
+    def test_load_finished_comic_for_update(self):
+        base = "https://www.mangatown.com/manga/azumi/"
+        state = {PageDownload(base + "c001/"): True,
+                 PageDownload(base + "c002/"): True,
+                 FileDownload(base + "c002.jpg", pathlib.Path()): True}
+        with tempfile.TemporaryDirectory() as tmp:
+            directory = pathlib.Path(tmp)
+            with (directory / "state.pickle.done").open("wb") as fp:
+                pickle.dump(state, fp)
+            session = unittest.mock.Mock(headers={})
+            crawler = asyncio.run(Site.load(directory, session, update=True))
+            self.assertIsInstance(crawler, MangaTown)
+            self.assertEqual(asyncio.run(crawler.queue.get()),
+                             PageDownload(base + "c002/"))
+            crawler.queue.task_done()
+            crawler.dump()
+            self.assertEqual(sorted(p.name for p in directory.iterdir()),
+                             ["state.pickle.done"])
+            with (directory / "state.pickle.done").open("rb") as fp:
+                self.assertEqual(pickle.load(fp), state)
+
+
+class InferenceTests(unittest.TestCase):
+
+    def test_template_with_padding(self):
+        template = Template.infer({1: "a/v000.jpg", 2: "a/v001.jpg",
+                                   4: "a/v003.jpg"})
+        self.assertEqual(template, Template("a/v", -1, 3, ".jpg"))
+        self.assertEqual(template.format(12), "a/v011.jpg")
+
+    def test_template_without_padding(self):
+        template = Template.infer({9: "Azumi 1 - Page 9.jpg",
+                                   10: "Azumi 1 - Page 10.jpg"})
+        self.assertEqual(template.format(8), "Azumi 1 - Page 8.jpg")
+        self.assertEqual(template.format(11), "Azumi 1 - Page 11.jpg")
+
+    def test_no_template(self):
+        self.assertIsNone(Template.infer({1: "a/1/x.jpg", 2: "a/2/y.jpg"}))
+        self.assertIsNone(Template.infer({1: "a/1/1.jpg", 2: "a/2/2.jpg"}))
+        self.assertIsNone(Template.infer({1: "a/1.jpg", 2: "a/3.jpg",
+                                          3: "a/4.jpg"}))
+        self.assertIsNone(Template.infer({1: "a.jpg", 2: "a.jpg"}))
+
+    def test_mangatown(self):
+        page = "https://www.mangatown.com/manga/azumi/c264/"
+        image = "https://zjcdn.mangahere.org/store/manga/13495/264.0/" \
+            "compressed/v{:03}.jpg"
+        inference = Inference(MangaTown.page_pattern)
+        for i in [1, 3, 2]:
+            url = page + f"{i}.html" if i > 1 else page
+            self.assertIsNone(inference.predict(url))
+            inference.observe(url, [(image.format(i - 1),
+                                     f"264.0/v{i - 1:03}.jpg")])
+        self.assertEqual(inference.predict(page + "27.html"),
+                         (image.format(26), "264.0/v026.jpg"))
+        self.assertIsNone(inference.predict(page + "featured.html"))
+        self.assertIsNone(inference.predict(
+            "https://www.mangatown.com/manga/azumi/c265/2.html"))
+        inference.fail(page + "27.html")
+        self.assertIsNone(inference.predict(page + "26.html"))
+        for i in [5, 6, 7]:
+            inference.observe(page + f"{i}.html", [(image.format(i),
+                                                    f"264.0/v{i:03}.jpg")])
+        self.assertIsNone(inference.predict(page + "27.html"))
+
+    def test_pages_with_several_images_are_ignored(self):
+        page = "https://www.mangatown.com/manga/azumi/c051/{}.html"
+        inference = Inference(MangaTown.page_pattern)
+        inference.observe(page.format(2), [("a0", "b0"), ("a1", "b1")])
+        for i in range(3, 6):
+            inference.observe(page.format(i), [(f"a{i}", f"b{i}")])
+        self.assertIsNone(inference.predict(page.format(6)))
+
+    def test_wrong_prediction_stops_inference(self):
+        page = "https://www.mangareader.net/azumi/1/{}"
+        inference = Inference(MangaReader.page_pattern)
+        for i in range(1, 4):
+            inference.observe(page.format(i), [(f"https://x/{i}.jpg",
+                                                f"Azumi 1/Page {i}.jpg")])
+        self.assertEqual(inference.predict(page.format(5)),
+                         ("https://x/5.jpg", "Azumi 1/Page 5.jpg"))
+        inference.observe(page.format(4), [("https://x/7.jpg",
+                                            "Azumi 1/Page 4.jpg")])
+        self.assertIsNone(inference.predict(page.format(5)))
+
+    def test_taadd_images_can_not_be_predicted(self):
+        html = load_html("taadd.html")
+        [image] = Taadd.extract_images(html)
+        inference = Inference(Taadd.page_pattern)
+        base = "https://www.taadd.com/chapter/BattleAngelAlitaLastOrder1/"
+        for i, name in enumerate(["dd146c8b", "0a1b2c3d", "99ff00aa"], 1):
+            url = image.url.replace("dd146c8b", name)
+            inference.observe(base + f"487056-{i}.html",
+                              [(url, str(image.path))])
+        self.assertIsNone(inference.predict(base + "487056-4.html"))
+
+
+class StubResponse:
+
+    def __init__(self, body, status=200, content_type="text/html"):
+        self.body = body
+        self.status = status
+        self.ok = status < 400
+        self.content_type = content_type
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        pass
+
+    def raise_for_status(self):
+        if not self.ok:
+            raise aiohttp.ClientError(self.status)
+
+    async def read(self):
+        return self.body
+
+
+class StubSession:
+
+    def __init__(self, responses):
+        self.responses = responses
+        self.requests = []
+        self.headers = {}
+
+    async def get(self, url, headers=None):
+        self.requests.append(url)
+        response = self.responses[url]
+        if isinstance(response, BaseException):
+            raise response
+        return response
+
+
+class PredictedPageTests(unittest.TestCase):
+
+    chapter = "https://www.mangatown.com/manga/azumi/c264/"
+    image = "https://zjcdn.mangahere.org/store/manga/13495/264.0/" \
+        "compressed/v{:03}.jpg"
+
+    def handle_page(self, image_response):
+        """Let a crawler with a learned pattern handle page 4 of a chapter"""
+        page = self.chapter + "4.html"
+        html = (pathlib.Path("test") / "mangatown.com.html").read_bytes()
+        session = StubSession({self.image.format(3): image_response,
+                               page: StubResponse(html)})
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.dir = pathlib.Path(tmp.name)
+
+        async def run():
+            crawler = self.crawler = MangaTown(Queue(), self.dir, session)
+            crawler.infer = True
+            for i in range(1, 4):
+                crawler.inference.observe(
+                    self.chapter + f"{i}.html",
+                    [(self.image.format(i - 1), f"264.0/v{i - 1:03}.jpg")])
+            await crawler.handle_page(PageDownload(page))
+            return crawler.queue.get_state()
+        return session.requests, asyncio.run(run())
+
+    def test_correct_prediction(self):
+        response = StubResponse(b"image", content_type="image/jpeg")
+        requests, state = self.handle_page(response)
+        self.assertEqual(requests, [self.image.format(3)])
+        image = FileDownload(self.image.format(3),
+                             pathlib.Path("264.0/v003.jpg"))
+        self.assertEqual(state, {image: True})
+        self.assertEqual((self.dir / image.path).read_bytes(), b"image")
+
+    def assertFallback(self, requests, state):
+        self.assertEqual(requests, [self.image.format(3),
+                                    self.chapter + "4.html"])
+        self.assertFalse((self.dir / "264.0" / "v003.jpg").exists())
+        # the image from the html page is queued instead
+        image = FileDownload(self.image.format(0),
+                             pathlib.Path("264.0/v000.jpg"))
+        self.assertIs(state[image], False)
+
+    def test_missing_image(self):
+        self.assertFallback(*self.handle_page(StubResponse(b"", 404)))
+
+    def test_no_image(self):
+        self.assertFallback(*self.handle_page(StubResponse(b"<html>")))
+
+    def test_octet_stream_image(self):
+        response = StubResponse(b"\xff\xd8\xff\xe0 image",
+                                content_type="application/octet-stream")
+        requests, state = self.handle_page(response)
+        self.assertEqual(requests, [self.image.format(3)])
+
+    def test_no_new_pattern_after_a_failed_prediction(self):
+        requests, state = self.handle_page(StubResponse(b"<html>"))
+        self.assertFallback(requests, state)
+        inference = self.crawler.inference
+        for i in range(5, 8):
+            inference.observe(self.chapter + f"{i}.html",
+                              [(self.image.format(i - 1),
+                                f"264.0/v{i - 1:03}.jpg")])
+        self.assertIsNone(inference.predict(self.chapter + "9.html"))
+
+    def test_timeout(self):
+        self.assertFallback(*self.handle_page(asyncio.TimeoutError()))
+
+    def test_connection_error(self):
+        error = aiohttp.ClientConnectionError()
+        self.assertFallback(*self.handle_page(error))
+
+
+class HandlePageTests(unittest.TestCase):
+
+    def test_pages_are_queued_if_the_image_is_missing(self):
+        html = load_html("xkcd.html")
+        html.find("div", id="comic").img.decompose()
+        session = StubSession(
+            {"https://xkcd.com/": StubResponse(str(html).encode())})
+
+        async def run():
+            crawler = Xkcd(Queue(), pathlib.Path(), session)
+            with self.assertRaises(TypeError):
+                await crawler.handle_page(PageDownload("https://xkcd.com/"))
+            return crawler.queue.get_state()
+        state = asyncio.run(run())
+        self.assertEqual(len(state), 2226)
+        self.assertIn(PageDownload("https://xkcd.com/2227/"), state)